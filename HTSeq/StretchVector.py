@@ -1,11 +1,160 @@
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from types import SimpleNamespace
+import bisect
+import os
+import sys
+import weakref
 import numpy as np
 import warnings
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Compiled kernels from the Cython extension, if it was built
+try:
+    from HTSeq import _StretchVector
+except ImportError:
+    _StretchVector = None
+
 
 Interval = namedtuple('Interval', ['start', 'end'])
 
 
+class _ReadOnlyList(list):
+    """List that raises on in-place changes
+
+    StretchVector.ivs is rebuilt from the stretch bounds at every access, so
+    changes to it would be silently lost.
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError(
+            'StretchVector.ivs is read-only, assign a new list to it instead')
+
+    append = extend = insert = remove = pop = clear = _read_only
+    sort = reverse = _read_only
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def _jit(func):
+    """Compile a kernel with numba if available, else keep it pure Python
+
+    Compiled kernels release the GIL, so they can run concurrently in threads.
+    """
+    if numba is None:
+        return func
+    return numba.njit(cache=True, boundscheck=False, nogil=True)(func)
+
+
+@_jit
+def _find_overlap_nb(starts, ends, start, end):
+    """Stretches overlapping [start, end) and the bounds of their merge with it
+
+    Args:
+        starts (np.ndarray of np.int64): Sorted starts of the stretches.
+        ends (np.ndarray of np.int64): Sorted ends of the stretches.
+        start (int): Start of the interval.
+        end (int): End of the interval.
+
+    Returns:
+        (i0, i1, new_start, new_end) where the stretches [i0, i1) overlap the
+        interval, and [new_start, new_end) covers both them and the interval.
+    """
+    # Appending after the last stretch is the common case, e.g. when reads
+    # come sorted by coordinate
+    n = len(starts)
+    if (n == 0) or (start >= ends[n - 1]):
+        return n, n, start, end
+
+    # The overlapping stretches end after start and begin before end
+    i0 = np.searchsorted(ends, start, side='right')
+    i1 = np.searchsorted(starts, end, side='left')
+    if i1 > i0:
+        start = min(start, starts[i0])
+        end = max(end, ends[i1 - 1])
+    return i0, i1, start, end
+
+
+@_jit
+def _splice_bounds_nb(starts, ends, n, i0, i1, new_start, new_end):
+    """Replace the stretch bounds [i0, i1) with a single stretch, in place
+
+    Args:
+        starts (np.ndarray of np.int64): Buffer with the sorted starts of the
+          stretches in its first n elements, and room for one more if i0 ==
+          i1.
+        ends (np.ndarray of np.int64): Same for the ends of the stretches.
+        n (int): Number of stretches.
+        i0 (int): First stretch to replace.
+        i1 (int): End of the stretches to replace, i0 to insert a new one.
+        new_start (int): Start of the replacement stretch.
+        new_end (int): End of the replacement stretch.
+
+    Returns:
+        The new number of stretches.
+    """
+    # Shift the following stretches to make room for a new one or to close
+    # the gap left by merged ones
+    n_new = n + 1 - (i1 - i0)
+    if n_new != n:
+        starts[i0 + 1: n_new] = starts[i1: n]
+        ends[i0 + 1: n_new] = ends[i1: n]
+    starts[i0] = new_start
+    ends[i0] = new_end
+    return n_new
+
+
+# The Cython kernels have no compilation delay, so prefer them over numba
+if _StretchVector is not None:
+    _find_overlap_bounds = _StretchVector.find_overlap
+    _splice_bounds = _StretchVector.splice_bounds
+else:
+    _find_overlap_bounds = _find_overlap_nb
+    _splice_bounds = _splice_bounds_nb
+
+
+@_jit
+def _find_flips_nb(array):
+    """Indices i where array[i] and array[i + 1] differ in being NaN"""
+    flips = np.empty(len(array), np.int64)
+    n = 0
+    # NaN is the only value that differs from itself
+    prev = array[0] != array[0]
+    for i in range(1, len(array)):
+        cur = array[i] != array[i]
+        if cur != prev:
+            flips[n] = i - 1
+            n += 1
+            prev = cur
+    return flips[:n]
+
+
+def _find_flips(array):
+    """Indices i where array[i] and array[i + 1] differ in being NaN"""
+    # The compiled kernel does it in one pass without temporaries
+    if (numba is not None) and (array.dtype.kind == 'f'):
+        return _find_flips_nb(array)
+    # XOR of the shifted mask saves the temporary of np.diff
+    nan_mask = np.isnan(array)
+    return np.flatnonzero(nan_mask[1:] ^ nan_mask[:-1])
+
+
+@lru_cache(maxsize=None)
+def _ops_for(typecode):
+    """Allocation helpers with the dtype of a typecode resolved once"""
+    dtype = np.dtype(StretchVector._typecode_dict[typecode])
+    return SimpleNamespace(
+        dtype=dtype,
+        empty=partial(np.empty, dtype=dtype),
+    )
+
+
 class StretchVector:
     """Sparse representation for 'island' of dense data on a long line.
 
@@ -33,6 +182,19 @@ class StretchVector:
     You can use StretchVector as a storage option for higher level objects such
     as ChromVector and GenomicArray. Those classes support strandedness, unlike
     StretchVector itself.
+
+    The lookups and updates of the stretch bounds run in compiled kernels that
+    release the GIL: the Cython ones of the HTSeq._StretchVector extension,
+    which is built with HTSeq, or numba ones if the extension is missing.
+    Together with numpy, which releases the GIL while copying numeric data,
+    this lets separate StretchVectors (e.g. one per BAM file) be filled
+    concurrently from several threads, although the rest of each call runs
+    in Python. A single StretchVector must not be modified from more than one
+    thread at a time, but can be read from many.
+
+    The "fast" extra (pip install HTSeq[fast]) installs numba, which compiles
+    the NaN scan of from_dense, and the bound kernels if the extension is not
+    built. Importing numba adds a noticeable delay to importing HTSeq.
     """
     _typecode_dict = {
         "d": np.float32,
@@ -40,6 +202,24 @@ class StretchVector:
         "l": np.int64,
         "O": object,
     }
+    _reverse_typecode_dict = {
+        np.dtype(dtype): typecode for typecode, dtype in _typecode_dict.items()
+    }
+
+    # Below this number of stretches, a plain bisect on the stretch ends is
+    # faster than dispatching to numpy
+    _bisect_max = 16
+
+    # Dense arrays up to this length are cached by todense. Longer ones, e.g.
+    # whole chromosomes, are usually exported once and not worth keeping
+    _dense_cache_max = 1_000_000
+
+    # Below this mean stretch length, todense fills the gaps with NaN in bulk
+    _todense_fill_max = 2000
+
+    # Dense arrays from this length on are stitched by several threads
+    _parallel_todense_min = 10_000_000
+    _parallel_todense_threads = os.cpu_count() or 1
 
     def __init__(self, typecode):
         """Create an empty StretchVector of a given type
@@ -54,235 +234,207 @@ class StretchVector:
             A StretchVector instance of the chosen type.
         """
         self.typecode = typecode
-        self.ivs = []
+        self._ops = _ops_for(typecode)
+        # Starts and ends of the stretches are stored as two sorted arrays,
+        # which are views into buffers with spare capacity
+        self._set_bounds(np.empty(0, np.int64), np.empty(0, np.int64))
         self.stretches = []
+        # Incremented by every modification, to invalidate the todense cache
+        self._version = 0
+        self._dense_cache = None
+        self._dense_cache_version = -1
+        # Weak reference to the StretchVector this one is a slice of, which
+        # shares its data
+        self._parent = None
+
+    def __getstate__(self):
+        # The bounds are views into the buffers, which pickle and deepcopy
+        # would turn into separate arrays, so the buffers are rebuilt instead.
+        # The allocation helpers are rebuilt from the typecode, so that
+        # pickles do not depend on numpy internals. The todense cache can be
+        # much larger than the data, and a copy does not share its data with
+        # the parent of a slice anyway
+        state = self.__dict__.copy()
+        del state['_starts_buf'], state['_ends_buf'], state['_ops']
+        state['_dense_cache'] = None
+        state['_dense_cache_version'] = -1
+        state['_parent'] = None
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        # Older pickles have a list of intervals instead of the bounds
+        ivs = state.pop('ivs', None)
+        self.__init__(state['typecode'])
+        self.__dict__.update(state)
+        if ivs is not None:
+            self.ivs = ivs
+        else:
+            # copy.copy passes the state of the original as is, so the bounds
+            # and the list of stretches must not be shared with it
+            self._set_bounds(self._starts.copy(), self._ends.copy())
+        self.stretches = list(self.stretches)
+
+    def _bump_version(self):
+        """Invalidate the todense cache, including that of the parents"""
+        sv = self
+        while sv is not None:
+            sv._version += 1
+            sv = sv._parent() if sv._parent is not None else None
+
+    @property
+    def ivs(self):
+        """Read-only list of (start, end) intervals of the stretches
+
+        This is a snapshot built at every access. To change the intervals,
+        assign a new list, which must match self.stretches.
+        """
+        return _ReadOnlyList(
+            Interval(start, end) for start, end in
+            zip(self._starts.tolist(), self._ends.tolist())
+        )
+
+    @ivs.setter
+    def ivs(self, ivs):
+        self._bump_version()
+        self._set_bounds(
+            np.array([iv[0] for iv in ivs], np.int64),
+            np.array([iv[1] for iv in ivs], np.int64),
+        )
+
+    def _set_bounds(self, starts, ends):
+        """Replace the stretch bounds, with no spare capacity"""
+        self._starts = self._starts_buf = starts
+        self._ends = self._ends_buf = ends
+
+    def _find_overlap(self, start, end):
+        """Stretches overlapping [start, end) and the bounds of their merge
+
+        Returns:
+            (i0, i1, new_start, new_end) where the stretches [i0, i1) overlap
+            the interval, and [new_start, new_end) covers both them and the
+            interval. Nothing is changed, see _update_bounds.
+        """
+        i0, i1, new_start, new_end = _find_overlap_bounds(
+            self._starts, self._ends, start, end,
+        )
+        return int(i0), int(i1), int(new_start), int(new_end)
+
+    def _update_bounds(self, i0, i1, new_start, new_end):
+        """Replace the bounds of the stretches [i0, i1) with a single stretch
+
+        The caller needs to update self.stretches to match. Callers build the
+        new stretch first, so that invalid values leave self unchanged.
+        """
+        n = len(self._starts)
+        # Grow the buffers geometrically, so that adding stretches one by one
+        # takes amortized constant time
+        if (i1 == i0) and (n == len(self._starts_buf)):
+            capacity = max(2 * n, 4)
+            self._starts_buf = np.empty(capacity, np.int64)
+            self._ends_buf = np.empty(capacity, np.int64)
+            self._starts_buf[:n] = self._starts
+            self._ends_buf[:n] = self._ends
+
+        n = _splice_bounds(
+            self._starts_buf, self._ends_buf, n, i0, i1, new_start, new_end,
+        )
+        self._starts = self._starts_buf[:n]
+        self._ends = self._ends_buf[:n]
 
     def _in_stretch(self, index):
-        if len(self.stretches) == 0:
+        """Index of the stretch containing a coordinate, -1 if none does"""
+        if _StretchVector is not None:
+            return _StretchVector.in_stretch(self._starts, self._ends, index)
+
+        n = len(self._starts)
+        if n == 0:
             return -1
 
-        if isinstance(index, int):
-            if (index < self.ivs[0].start) or (index >= self.ivs[-1].end):
-                return -1
-            for i, iv in enumerate(self.ivs):
-                if index < iv.start:
-                    return -1
-                if index < iv.end:
-                    return i
+        # Stretches are sorted and disjoint, so the only candidate is the
+        # first one ending after index, which must also start before it
+        if n <= self._bisect_max:
+            i = bisect.bisect_right(self._ends, index)
+        else:
+            i = int(np.searchsorted(self._ends, index, side='right'))
+        if (i == n) or (index < self._starts[i]):
+            return -1
+        return i
 
     def _get_interval(self, start, end):
         if len(self.stretches) == 0:
             return self
 
-        ivs = []
-        stretches = []
-        for i, iv in enumerate(self.ivs):
-            # They end before the start, skip
-            if iv.end <= start:
-                continue
-
-            # They start after the end, skip all remaining
-            if iv.start >= end:
-                break
-
-            # This interval overlap with start-end
-            if (iv.start <= start) and (iv.end <= end):
-                new_iv = Interval(start, iv.end)
-                new_stretch = self.stretches[i][start - iv.start:]
-                ivs.append(new_iv)
-                stretches.append(new_stretch)
-                continue
-
-            if (iv.start <= start) and (iv.end > end):
-                new_iv = Interval(start, end)
-                new_stretch = self.stretches[i][start - iv.start:-(iv.end - end)]
-                ivs.append(new_iv)
-                stretches.append(new_stretch)
-                break
-
-            if (iv.start > start) and (iv.end <= end):
-                new_iv = Interval(iv.start, iv.end)
-                new_stretch = self.stretches[i]
-                ivs.append(new_iv)
-                stretches.append(new_stretch)
-                continue
-
-            if (iv.start > start) and (iv.end > end):
-                new_iv = Interval(iv.start, end)
-                new_stretch = self.stretches[i][:-(iv.end - end)]
-                ivs.append(new_iv)
-                stretches.append(new_stretch)
-                break
+        # The overlapping stretches end after start and begin before end
+        i0 = int(np.searchsorted(self._ends, start, side='right'))
+        i1 = int(np.searchsorted(self._starts, end, side='left'))
 
         new_cls = self.__class__(self.typecode)
-        new_cls.ivs = ivs
+        if (i1 <= i0) or (end <= start):
+            return new_cls
+
+        # Stretches in the middle are kept whole, only the first and the
+        # last one might need trimming
+        stretches = self.stretches[i0:i1]
+        l1 = start - self._starts[i0]
+        if l1 > 0:
+            stretches[0] = stretches[0][l1:]
+        l2 = self._ends[i1 - 1] - end
+        if l2 > 0:
+            stretches[-1] = stretches[-1][:len(stretches[-1]) - l2]
+
+        new_cls._set_bounds(
+            np.maximum(self._starts[i0:i1], start),
+            np.minimum(self._ends[i0:i1], end),
+        )
         new_cls.stretches = stretches
+        new_cls._parent = weakref.ref(self)
         return new_cls
 
     def _set_interval(self, start, end, values):
-        if len(self.stretches) == 0:
-            self.ivs.append(Interval(start, end))
-            self.stretches.append(
-                np.zeros(end - start, self._typecode_dict[self.typecode])
-            )
-            self.stretches[-1][:] = values
-            return len(self.ivs) - 1
-
-        # For each end, there are two possibilities, inside or outside an
-        # existing stretch
-        idx_start = self._in_stretch(start)
-        idx_end = self._in_stretch(end - 1)
-
-        # Neither is in, make a new stretch and delete existing stretches
-        if idx_start == idx_end == -1:
-            new_iv = Interval(start, end)
-            new_stretch = np.zeros(end - start, self._typecode_dict[self.typecode])
-            new_stretch[:] = values
-            new_ivs = []
-            new_stretches = []
-            new_added = False
-            for i, iv in enumerate(self.ivs):
-                # Stretches before
-                if start >= iv.end:
-                    new_ivs.append(iv)
-                    new_stretches.append(self.stretches[i])
-                    continue
-
-                # Add new stretch
-                if not new_added:
-                    new_ivs.append(new_iv)
-                    new_stretches.append(new_stretch)
-
-                # Skip overlapping stretches
-                if (start <= iv.start) and (end >= iv.end):
-                    continue
-
-                # Stretches after
-                new_ivs.append(iv)
-                new_stretches.append(self.stretches[i])
-
-            # Add new stretch if still missing
-            if not new_added:
-                new_ivs.append(new_iv)
-                new_stretches.append(new_stretch)
-
-        # Start is in a stretch, end is not
-        elif (idx_start != -1) and (idx_end == -1):
-            new_iv = Interval(self.ivs[idx_start].start, end)
-            new_stretch = np.zeros(
-                end - self.ivs[idx_start].start,
-                self._typecode_dict[self.typecode],
-            )
-            l1 = start - self.ivs[idx_start].start
-            new_stretch[:l1] = self.stretches[idx_start][:l1]
-            new_stretch[l1:] = values
-
-            new_ivs = self.ivs[:idx_start] + [new_iv]
-            new_stretches = self.stretches[:idx_start] = [new_stretch]
-
-            for i, iv in enumerate(self.ivs[idx_start:], idx_start):
-                # Skip the first one
-                if i == idx_start:
-                    continue
-
-                # Skip overlapping stretches
-                if iv.end < end:
-                    continue
-
-                # Stretches after
-                new_ivs.append(iv)
-                new_stretches.append(self.stretches[i])
-
-        # Start is not in a stretch, end is
-        elif (idx_start == -1) and (idx_end != -1):
-            new_iv = Interval(start, self.ivs[idx_end].end)
-            new_stretch = np.zeros(
-                self.ivs[idx_end].end - start,
-                self._typecode_dict[self.typecode],
-            )
-            l2 = self.ivs[idx_end].end - end
-            if l2 == 0:
-                l2 = -len(self.stretches[idx_end])
-            new_stretch[:-l2] = values
-            if -l2 != len(self.stretches[idx_end]):
-                new_stretch[-l2:] = self.stretches[idx_end][-l2:]
-
-            new_ivs = []
-            new_stretches = []
-            for i, iv in enumerate(self.ivs):
-                # Stretches before
-                if start >= iv.end:
-                    new_ivs.append(iv)
-                    new_stretches.append(self.stretches[i])
-                    continue
-                break
-
-            # New stretch
-            new_ivs.append(new_iv)
-            new_stretches.append(new_stretch)
-
-            # If there are stretches left, add them
-            if idx_end != len(self.ivs) - 1:
-                new_ivs.extend(self.ivs[idx_end+1:])
-                new_stretches.extend(self.stretches[idx_end+1:])
-
-        # Both start and end are in the same stretch
-        elif idx_start == idx_end:
-            l1 = start - self.ivs[idx_start].start
-            l2 = self.ivs[idx_end].end - end
-            if l2 == 0:
-                l2 = -len(self.stretches[idx_end])
-            new_ivs = self.ivs
-            new_stretches = self.stretches
-            new_stretches[idx_start][l1:-l2] = values
-
-        # They are in different stretches
+        start, end = int(start), int(end)
+
+        # Both start and end are in the same stretch, write in place
+        idx = self._in_stretch(start)
+        if (idx != -1) and (end <= self._ends[idx]):
+            l1 = start - self._starts[idx]
+            self.stretches[idx][l1: l1 + end - start] = values
+            return
+
+        i0, i1, new_start, new_end = self._find_overlap(start, end)
+
+        # Otherwise, all overlapping stretches are merged into a new one,
+        # which keeps the head of the first and the tail of the last. Those
+        # and the values cover the whole new stretch, so no need to zero it
+        new_stretch = self._ops.empty(new_end - new_start)
+        l1 = start - new_start
+        l2 = new_end - end
+        if l1 > 0:
+            new_stretch[:l1] = self.stretches[i0][:l1]
+        new_stretch[l1: end - new_start] = values
+        if l2 > 0:
+            new_stretch[-l2:] = self.stretches[i1 - 1][-l2:]
+
+        # The bounds change last, once the values are known to fit
+        self._update_bounds(i0, i1, new_start, new_end)
+        self._splice_stretch(i0, i1, new_stretch)
+
+    def _splice_stretch(self, i0, i1, new_stretch):
+        """Replace the stretches [i0, i1) with a new one, in place"""
+        if i1 == i0:
+            self.stretches.insert(i0, new_stretch)
         else:
-            new_iv = Interval(
-                    self.ivs[idx_start].start,
-                    self.ivs[idx_end].end,
-                )
-            new_stretch = np.zeros(
-                self.ivs[idx_end].end - self.ivs[idx_start].start,
-                self._typecode_dict[self.typecode],
-            )
-            l1 = start - self.ivs[idx_start].start
-            l2 = self.ivs[idx_end].end - end
-            if l2 == 0:
-                l2 = -len(self.stretches[idx_end])
-            new_stretch[:l1] = self.stretches[idx_start][:l1]
-            new_stretch[l1:-l2] = values
-            if -l2 != len(self.stretches[idx_end]):
-                new_stretch[-l2:] = self.stretches[idx_end][-l2:]
-
-            new_ivs = self.ivs[:idx_start] + [iv]
-            if idx_end != len(self.ivs) - 1:
-                new_ivs.extend(self.ivs[idx_end+1:])
-                new_stretches.extend(self.stretches[idx_end+1:])
-
-        self.ivs = new_ivs
-        self.stretches = new_stretches
-
-    def _add_stretch(self, start, end, i_start=0):
-        for i, iv in enumerate(self.ivs, i_start):
-            if start < iv.start:
-                self.ivs.insert(
-                    i,
-                    Interval(start, end),
-                )
-                self.stretches.insert(
-                    i,
-                    np.zeros(end - start, self._typecode_dict[self.typecode])
-                )
-                return i
-
-        self.ivs.append(
-            Interval(start, end),
-        )
-        self.stretches.append(
-            np.zeros(end - start, self._typecode_dict[self.typecode])
-        )
-        return len(self.ivs) - 1
+            self.stretches[i0] = new_stretch
+            del self.stretches[i0 + 1: i1]
+
+    def _add_stretch(self, start, end, values):
+        # Callers only add stretches that do not overlap existing ones. The
+        # stretch is filled first, so that invalid values leave self unchanged
+        new_stretch = self._ops.empty(end - start)
+        new_stretch[:] = values
+        i, _, _, _ = self._find_overlap(start, end)
+        self._update_bounds(i, i, start, end)
+        self.stretches.insert(i, new_stretch)
 
     def __getitem__(self, index):
         """Get a view of a portion of the StretchVector
@@ -304,20 +456,21 @@ class StretchVector:
             idx_iv = self._in_stretch(index)
             if idx_iv == -1:
                 return None
-            return self.stretches[idx_iv][index - self.ivs[idx_iv].start]
+            return self.stretches[idx_iv][index - self._starts[idx_iv]]
 
         elif isinstance(index, slice):
             if index.step is not None and index.step != 1:
                 raise ValueError(
                         "Striding slices (i.e., step != 1) are not supported")
-            if index.start is None:
-                index.start = 0
-            if index.stop is None:
-                if len(self.ivs) == 0:
+            start, stop = index.start, index.stop
+            if start is None:
+                start = 0
+            if stop is None:
+                if len(self._ends) == 0:
                     raise IndexError('No stretches, cannot find end')
-                index.stop = self.ivs[-1].end
+                stop = self._ends[-1]
 
-            return self._get_interval(index.start, index.stop)
+            return self._get_interval(start, stop)
 
         elif isinstance(index, GenomicInterval):
             return self.__getitem__(slice(index.start, index.end))
@@ -339,52 +492,272 @@ class StretchVector:
 
         # Leave dtype out for now for speed, it will be taken care of later on
         values = np.asarray(values)
+        self._bump_version()
 
         if isinstance(index, int):
             idx_iv = self._in_stretch(index)
             if idx_iv == -1:
-                idx_iv = self._add_stretch(index, index + 1)
-            self.stretches[idx_iv][index - self.ivs[idx_iv].start] = values
+                self._add_stretch(index, index + 1, values)
+            else:
+                self.stretches[idx_iv][index - self._starts[idx_iv]] = values
             return
 
         elif isinstance(index, slice):
             if index.step is not None and index.step != 1:
                 raise ValueError(
                         "Striding slices (i.e., step != 1) are not supported")
-            if index.start is None:
-                index.start = 0
-            if index.stop is None:
-                if len(self.ivs) == 0:
+            start, stop = index.start, index.stop
+            if start is None:
+                start = 0
+            if stop is None:
+                if len(self._ends) == 0:
                     raise IndexError('No stretches, cannot find end')
-                index.stop = self.ivs[-1].end
+                stop = self._ends[-1]
 
-            self._set_interval(index.start, index.stop, values)
+            # Fast path for the most common pattern, e.g. coverage from
+            # sorted reads: the interval is within the last stretch
+            if (len(self._starts) != 0) and (start >= self._starts[-1]) and (stop <= self._ends[-1]):
+                l1 = start - self._starts[-1]
+                self.stretches[-1][l1: l1 + stop - start] = values
+                return
+
+            self._set_interval(start, stop, values)
 
         elif isinstance(index, GenomicInterval):
             return self.__setitem__(slice(index.start, index.end), values)
 
+    def extend(self, intervals, values_list):
+        """Set values on many intervals at once
+
+        This is equivalent to setting each interval in turn, i.e. later
+        intervals overwrite earlier ones where they overlap, but the stretches
+        are rebuilt in a single sorted sweep instead of once per interval.
+
+        Args:
+            intervals (sequence of (start, end) pairs or GenomicInterval):
+              Intervals to set.
+            values_list (sequence): One value or array of values for each
+              interval, as in __setitem__.
+
+        Returns: None
+        """
+        intervals = list(intervals)
+        if len(intervals) != len(values_list):
+            raise ValueError('intervals and values_list differ in length')
+        if len(intervals) == 0:
+            return
+        self._bump_version()
+
+        n_old = len(self._starts)
+        starts = np.empty(n_old + len(intervals), np.int64)
+        ends = np.empty(n_old + len(intervals), np.int64)
+        starts[:n_old] = self._starts
+        ends[:n_old] = self._ends
+        for i, iv in enumerate(intervals, n_old):
+            if hasattr(iv, 'start'):
+                starts[i], ends[i] = iv.start, iv.end
+            else:
+                starts[i], ends[i] = iv
+
+        # Sort existing stretches and new intervals together. Existing
+        # stretches come first, and new intervals keep their order, on ties
+        order = np.argsort(starts, kind='stable')
+        starts = starts[order]
+        ends = ends[order]
+
+        # A new group begins when an interval starts at or after the end of
+        # everything before it, as in _set_interval
+        max_ends = np.maximum.accumulate(ends)
+        group_starts = np.concatenate(
+            [[0], np.flatnonzero(starts[1:] >= max_ends[:-1]) + 1])
+        group_ends = np.concatenate([group_starts[1:], [len(starts)]])
+
+        stretches = []
+        for g0, g1 in zip(group_starts.tolist(), group_ends.tolist()):
+            members = order[g0: g1]
+            # A single existing stretch is kept as is
+            if (g1 - g0 == 1) and (members[0] < n_old):
+                stretches.append(self.stretches[members[0]])
+                continue
+
+            # Every element of the group is covered by one of its members,
+            # existing stretches first and then new intervals by input order
+            new_start = starts[g0]
+            new_stretch = self._ops.empty(max_ends[g1 - 1] - new_start)
+            for j in np.sort(members).tolist():
+                if j < n_old:
+                    stretch = self.stretches[j]
+                    s0 = self._starts[j] - new_start
+                    new_stretch[s0: s0 + len(stretch)] = stretch
+                else:
+                    iv = intervals[j - n_old]
+                    s0, e0 = (iv.start, iv.end) if hasattr(iv, 'start') else iv
+                    new_stretch[s0 - new_start: e0 - new_start] = values_list[j - n_old]
+            stretches.append(new_stretch)
+
+        self._set_bounds(starts[group_starts], max_ends[group_ends - 1])
+        self.stretches = stretches
+
+    def add_at(self, start, values):
+        """Add values to the data starting at a certain coordinate
+
+        Args:
+            start (int): Coordinate of the first value.
+            values (numpy.ndarray or convertible sequence): Values to add.
+              Positions that are not in any stretch yet count as zero.
+
+        Returns: None
+        """
+        values = np.asarray(values)
+        if len(values) == 0:
+            return
+        end = start + len(values)
+        self._bump_version()
+
+        # Fast path: all within one stretch, add in place
+        idx = self._in_stretch(start)
+        if (idx != -1) and (end <= self._ends[idx]):
+            l1 = start - self._starts[idx]
+            self.stretches[idx][l1: l1 + len(values)] += values
+            return
+
+        # Otherwise, merge the overlapping stretches into a new one, copying
+        # each of them once and zeroing only the gaps between them
+        i0, i1, new_start, new_end = self._find_overlap(start, end)
+        new_stretch = self._ops.empty(new_end - new_start)
+        old_starts = self._starts[i0:i1].tolist()
+        pos = new_start
+        for old_start, stretch in zip(old_starts, self.stretches[i0:i1]):
+            new_stretch[pos - new_start: old_start - new_start] = 0
+            pos = old_start + len(stretch)
+            new_stretch[old_start - new_start: pos - new_start] = stretch
+        new_stretch[pos - new_start:] = 0
+        new_stretch[start - new_start: end - new_start] += values
+
+        # The bounds change last, once the values are known to fit
+        self._update_bounds(i0, i1, new_start, new_end)
+        self._splice_stretch(i0, i1, new_stretch)
+
+    def __iadd__(self, other):
+        """Add another StretchVector or a constant in place
+
+        Adding a StretchVector adds its stretches via add_at. Adding a
+        constant adds it to all existing stretches.
+        """
+        self._bump_version()
+        if isinstance(other, StretchVector):
+            for iv, stretch in other:
+                self.add_at(iv.start, stretch)
+        else:
+            for stretch in self.stretches:
+                stretch += other
+        return self
 
     def todense(self):
-        """Dense numpy array of the whole stretch, using NaNs for missing data"""
-        if len(self.ivs) == 0:
-            return np.empty(0, self._typecode_dict[self.typecode])
+        """Dense numpy array of the whole stretch, using NaNs for missing data
+
+        The result is cached and reused until the StretchVector is modified
+        through its methods, including those of views obtained by slicing,
+        so it is read-only: make a copy if you need to change it. In-place
+        changes to the arrays in self.stretches are not tracked and leave the
+        cache stale. Views obtained by slicing, which share their data with
+        their parent, and very long results are not cached and are writeable.
+        """
+        if self._dense_cache_version == self._version:
+            return self._dense_cache
+
+        res = self._todense()
+        if (self._parent is None) and (len(res) <= self._dense_cache_max):
+            res.flags.writeable = False
+            self._dense_cache = res
+            self._dense_cache_version = self._version
+        return res
 
-        if len(self.ivs) == 1:
+    def _todense(self):
+        if len(self._starts) == 0:
+            return self._ops.empty(0)
+
+        if len(self._starts) == 1:
             return self.stretches[0].copy()
 
         # At least two stretches, have to stitch them
-        start = self.ivs[0].start
+        start = self._starts[0]
         res = np.empty(
-            self.ivs[-1].end - start,
+            self._ends[-1] - start,
             self.stretches[0].dtype,
         )
-        res[:] = np.nan
-
-        for i, iv in enumerate(self.ivs):
-            res[iv.start - start: iv.end - start] = self.stretches[i]
+        dst_starts = (self._starts - start).tolist()
+        dst_ends = (self._ends - start).tolist()
+        dst_starts.append(len(res))
+        stretches = self.stretches
+
+        # Short stretches are cheaper to copy over a bulk NaN fill. Long ones
+        # are worth writing each element once, either from a stretch or as NaN
+        # in a gap
+        n = len(stretches)
+        fill_first = (self._ends - self._starts).sum() < self._todense_fill_max * n
+
+        def stitch(i_start, i_end):
+            if fill_first:
+                res[dst_starts[i_start]: dst_starts[i_end]] = np.nan
+                for i in range(i_start, i_end):
+                    res[dst_starts[i]: dst_ends[i]] = stretches[i]
+                return
+            for i in range(i_start, i_end):
+                res[dst_starts[i]: dst_ends[i]] = stretches[i]
+                res[dst_ends[i]: dst_starts[i + 1]] = np.nan
+
+        # Destinations are disjoint and numpy releases the GIL while copying
+        # (except for objects), so large arrays are split between threads
+        n_threads = min(self._parallel_todense_threads, n)
+        if (len(res) < self._parallel_todense_min) or (n_threads < 2) or (res.dtype == object):
+            stitch(0, n)
+            return res
+
+        # Balance the chunks by length rather than by number of stretches
+        bounds = np.searchsorted(
+            self._starts - start,
+            np.linspace(0, len(res), n_threads + 1)[1:-1],
+        ).tolist()
+        chunk_starts = [0] + bounds
+        chunk_ends = bounds + [n]
+        with ThreadPoolExecutor(n_threads) as executor:
+            list(executor.map(stitch, chunk_starts, chunk_ends))
 
         return res
 
+    def to_sparse(self):
+        """Sparse scipy representation of the whole stretch
+
+        Unlike todense, this does not allocate anything for the gaps between
+        stretches, which are implicit zeros instead of NaNs.
+
+        Returns:
+            A scipy.sparse.csr_array with a single row, whose columns are the
+            coordinates from 0 to the end of the last stretch.
+        """
+        try:
+            import scipy.sparse
+        except ImportError:
+            sys.stderr.write(
+                "Please install scipy to use StretchVector.to_sparse")
+            raise
+
+        if len(self._starts) == 0:
+            return scipy.sparse.csr_array((1, 0), dtype=self._ops.dtype)
+
+        # Build the CSR arrays directly, the single row holds all data
+        lengths = self._ends - self._starts
+        nnz = int(lengths.sum())
+        data = np.concatenate(self.stretches)
+        offsets = np.cumsum(lengths) - lengths
+        indices = np.arange(nnz) + np.repeat(self._starts - offsets, lengths)
+        indptr = np.array([0, nnz])
+        return scipy.sparse.csr_array(
+            (data, indices, indptr),
+            shape=(1, int(self._ends[-1])),
+        )
+
     @classmethod
     def from_dense(cls, array, offset=0):
         """Create from dense array with NaNs
@@ -398,23 +771,22 @@ class StretchVector:
             warnings.warn("np.float64 array converted to np.float32")
             array = array.astype(np.float32)
 
-        for typecode, dtype in cls._typecode_dict.items():
-            if dtype == array.dtype:
-                sv = cls(typecode=typecode)
-                break
-        else:
+        try:
+            typecode = cls._reverse_typecode_dict[array.dtype]
+        except KeyError:
             raise TypeError('Typecode not found for dtype: '+str(array.dtype))
+        sv = cls(typecode=typecode)
 
         if len(array) == 0:
             return sv
 
-        flips = np.diff(np.isnan(array)).nonzero()[0]
+        flips = _find_flips(array)
 
         # No flips: either all good or all skip
-        if flips.sum() == 0:
+        if len(flips) == 0:
             if np.isnan(array[0]):
                 return sv
-            sv.ivs.append(Interval(offset, offset + len(array)))
+            sv.ivs = [Interval(offset, offset + len(array))]
             sv.stretches.append(array.copy())
             return sv
 
@@ -429,7 +801,7 @@ class StretchVector:
                 flips = flips[1:]
                 flips -= add_offset
             else:
-                sv.ivs.append(Interval(offset, offset + len(array)))
+                sv.ivs = [Interval(offset, offset + len(array))]
                 sv.stretches.append(array.copy())
                 return sv
 
@@ -442,28 +814,16 @@ class StretchVector:
 
         # No flip left, all good
         if len(flips) == 0:
-            sv.ivs.append(Interval(offset, offset + len(array)))
+            sv.ivs = [Interval(offset, offset + len(array))]
             sv.stretches.append(array.copy())
             return sv
 
         # Now we start and end with a number/object, and there are at least
-        # two flips. Initial stretch
-        sv.ivs.append(Interval(offset, offset + flips[0] + 1))
-        sv.stretches.append(
-                array[:flips[0] + 1]
-        )
-        # Intermediate stretches
-        for i in range((len(flips) // 2) - 1):
-            new_iv = Interval(offset + flips[i * 2 + 1] + 1, offset + flips[i * 2 + 2] + 1)
-            new_stretch = array[flips[i * 2 + 1] + 1: flips[i * 2 + 2] + 1]
-            sv.ivs.append(new_iv)
-            sv.stretches.append(new_stretch)
-        # Final stretch
-        new_iv = Interval(offset + flips[-1] + 1, offset + len(array))
-        new_stretch = array[flips[-1] + 1:]
-        sv.ivs.append(new_iv)
-        sv.stretches.append(new_stretch)
-
+        # two flips. Odd flips end a stretch and even flips start the next one
+        starts = np.concatenate(([0], flips[1::2] + 1))
+        ends = np.concatenate((flips[0::2] + 1, [len(array)]))
+        sv._set_bounds(starts + offset, ends + offset)
+        sv.stretches = [array[s:e] for s, e in zip(starts, ends)]
         return sv
 
     def __iter__(self):
@@ -473,9 +833,8 @@ class StretchVector:
     def copy(self):
         """Make a copy the StretchVector and of all its stretches"""
         sv_new = StretchVector(typecode=self.typecode)
-        for iv, stretch in self:
-            sv_new.ivs.append(Interval(iv.start, iv.end))
-            sv_new.stretches.append(stretch.copy())
+        sv_new._set_bounds(self._starts.copy(), self._ends.copy())
+        sv_new.stretches = [stretch.copy() for stretch in self.stretches]
         return sv_new
 
     def shift(self, offset):
@@ -487,5 +846,6 @@ class StretchVector:
         Returns:
             None. The function acts in place.
         """
-        for i, iv in self.ivs:
-            self.ivs[i] = Interval(iv.start + offset, iv.end + offset)
+        self._bump_version()
+        self._starts += offset
+        self._ends += offset
@@ -69,6 +69,7 @@ kwargs = dict(
     ],
     extras_require={
         'htseq-qa': ['matplotlib>=1.4'],
+        'fast': ['numba'],
         'test': [
             'scipy>=1.5.0',
             'pytest>=6.2.5',
@@ -123,12 +124,14 @@ class Preprocess_command(Command):
         try:
             c(cython+' --version')
         except SubprocessError:
-            if os.path.isfile('src/_HTSeq.c'):
-                p('Cython not found, but transpiled file found')
+            if (os.path.isfile('src/_HTSeq.c') and
+                    os.path.isfile('src/_StretchVector.c')):
+                p('Cython not found, but transpiled files found')
             else:
                 raise
         else:
             c(cython+' -3 src/HTSeq/_HTSeq.pyx -o src/_HTSeq.c')
+            c(cython+' -3 src/HTSeq/_StretchVector.pyx -o src/_StretchVector.c')
 
         # SWIG
         p('SWIGging')
@@ -195,6 +198,10 @@ setup(name='HTSeq',
              ['src/_HTSeq.c'],
              include_dirs=[lazy_numpy_include_dir()],#+get_include_dirs(),
              extra_compile_args=['-w']),
+         Extension(
+             'HTSeq._StretchVector',
+             ['src/_StretchVector.c'],
+             extra_compile_args=['-w']),
          Extension(
              'HTSeq._StepVector',
              ['src/StepVector_wrap.cxx'],
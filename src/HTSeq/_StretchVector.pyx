@@ -0,0 +1,121 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""Compiled kernels for HTSeq.StretchVector
+
+The stretch bounds of a StretchVector are two sorted int64 arrays. These
+functions do the lookups and in-place updates on those arrays in C. The
+StretchVector class uses them when this extension is built, and otherwise
+falls back on the numba or pure Python versions of the same kernels.
+"""
+from libc.stdint cimport int64_t
+from libc.string cimport memmove
+
+
+cdef inline Py_ssize_t _bisect_left(
+        const int64_t[::1] a, Py_ssize_t n, int64_t x) noexcept nogil:
+    """First index i of a[:n] with a[i] >= x"""
+    cdef Py_ssize_t lo = 0, hi = n, mid
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if a[mid] < x:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+cdef inline Py_ssize_t _bisect_right(
+        const int64_t[::1] a, Py_ssize_t n, int64_t x) noexcept nogil:
+    """First index i of a[:n] with a[i] > x"""
+    cdef Py_ssize_t lo = 0, hi = n, mid
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if x < a[mid]:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def in_stretch(const int64_t[::1] starts, const int64_t[::1] ends, int64_t index):
+    """Index of the stretch containing a coordinate, -1 if none does
+
+    Args:
+        starts (np.ndarray of np.int64): Sorted starts of the stretches.
+        ends (np.ndarray of np.int64): Sorted ends of the stretches.
+        index (int): Coordinate to look up.
+    """
+    cdef Py_ssize_t n = starts.shape[0]
+    cdef Py_ssize_t i
+
+    with nogil:
+        i = _bisect_right(ends, n, index)
+        if (i == n) or (index < starts[i]):
+            i = -1
+    return i
+
+
+def find_overlap(
+        const int64_t[::1] starts, const int64_t[::1] ends,
+        int64_t start, int64_t end):
+    """Stretches overlapping [start, end) and the bounds of their merge with it
+
+    Same as HTSeq.StretchVector._find_overlap_nb.
+
+    Args:
+        starts (np.ndarray of np.int64): Sorted starts of the stretches.
+        ends (np.ndarray of np.int64): Sorted ends of the stretches.
+        start (int): Start of the interval.
+        end (int): End of the interval.
+
+    Returns:
+        (i0, i1, new_start, new_end) where the stretches [i0, i1) overlap the
+        interval, and [new_start, new_end) covers both them and the interval.
+    """
+    cdef Py_ssize_t n = starts.shape[0]
+    cdef Py_ssize_t i0 = n, i1 = n
+
+    with nogil:
+        # Appending after the last stretch is the common case, otherwise the
+        # overlapping stretches end after start and begin before end
+        if (n != 0) and (start < ends[n - 1]):
+            i0 = _bisect_right(ends, n, start)
+            i1 = _bisect_left(starts, n, end)
+            if i1 > i0:
+                start = min(start, starts[i0])
+                end = max(end, ends[i1 - 1])
+    return i0, i1, start, end
+
+
+def splice_bounds(
+        int64_t[::1] starts, int64_t[::1] ends, Py_ssize_t n,
+        Py_ssize_t i0, Py_ssize_t i1, int64_t new_start, int64_t new_end):
+    """Replace the stretch bounds [i0, i1) with a single stretch, in place
+
+    Same as HTSeq.StretchVector._splice_bounds_nb.
+
+    Args:
+        starts (np.ndarray of np.int64): Buffer with the sorted starts of the
+          stretches in its first n elements, and room for one more if i0 ==
+          i1.
+        ends (np.ndarray of np.int64): Same for the ends of the stretches.
+        n (int): Number of stretches.
+        i0 (int): First stretch to replace.
+        i1 (int): End of the stretches to replace, i0 to insert a new one.
+        new_start (int): Start of the replacement stretch.
+        new_end (int): End of the replacement stretch.
+
+    Returns:
+        The new number of stretches.
+    """
+    cdef Py_ssize_t n_new = n + 1 - (i1 - i0)
+
+    with nogil:
+        # Shift the following stretches to make room for a new one or to
+        # close the gap left by merged ones
+        if (n_new != n) and (n > i1):
+            memmove(&starts[i0 + 1], &starts[i1], (n - i1) * sizeof(int64_t))
+            memmove(&ends[i0 + 1], &ends[i1], (n - i1) * sizeof(int64_t))
+        starts[i0] = new_start
+        ends[i0] = new_end
+
+    return n_new
@@ -1,6 +1,9 @@
 import pytest
 import numpy as np
 import sys
+import copy
+import pickle
+import importlib
 import os
 import glob
 import sysconfig
@@ -18,12 +21,29 @@ import HTSeq
 data_folder = conftest.get_data_folder()
 
 
+sv_module = importlib.import_module('HTSeq.StretchVector')
+
+
 class TestStretchVector(unittest.TestCase):
     def test_init(self):
         sv = HTSeq.StretchVector(typecode='d')
         self.assertEqual(sv.ivs, [])
         self.assertEqual(sv.stretches, [])
 
+    def test_ivs_read_only(self):
+        sv = HTSeq.StretchVector(typecode='d')
+        sv[100: 110] = 1
+        with self.assertRaises(TypeError):
+            sv.ivs.append((120, 130))
+        with self.assertRaises(TypeError):
+            sv.ivs[0] = (100, 120)
+        self.assertEqual(sv.ivs, [(100, 110)])
+        self.assertEqual(pickle.loads(pickle.dumps(sv.ivs)), [(100, 110)])
+
+        sv.ivs = [(100, 110), (120, 130)]
+        sv.stretches.append(np.ones(10, np.float32))
+        self.assertEqual(sv[125], 1)
+
     def test_setitem_number(self):
         sv = HTSeq.StretchVector(typecode='d')
 
@@ -45,6 +65,12 @@ class TestStretchVector(unittest.TestCase):
             np.ones(1, np.float32) * 4,
         )
 
+        # Invalid values leave no new stretch behind
+        with self.assertRaises(ValueError):
+            sv[10] = 'x'
+        self.assertEqual(sv.ivs, [(560, 561)])
+        self.assertEqual(len(sv.stretches), 1)
+
     def test_setitem_slice(self):
         sv = HTSeq.StretchVector(typecode='d')
 
@@ -88,6 +114,100 @@ class TestStretchVector(unittest.TestCase):
             np.arange(20).astype(np.float32),
         )
 
+        # Set within a stretch that is not the last, up to its end
+        sv[290: 300] = np.arange(10)
+        self.assertEqual(len(sv.ivs), 2)
+        np.testing.assert_almost_equal(
+            sv.stretches[0][-10:],
+            np.arange(10).astype(np.float32),
+        )
+        np.testing.assert_almost_equal(
+            sv.stretches[0][-11],
+            4.5,
+        )
+
+    def test_setitem_slice_open(self):
+        sv = HTSeq.StretchVector(typecode='d')
+        with self.assertRaises(IndexError):
+            sv[100:] = 1
+
+        sv[100: 110] = 1
+        sv[120: 130] = 2
+
+        # Within the last stretch, open ended
+        sv[125:] = 3
+        self.assertEqual(sv.ivs, [(100, 110), (120, 130)])
+        np.testing.assert_almost_equal(
+            sv.stretches[1],
+            np.array([2] * 5 + [3] * 5, np.float32),
+        )
+        res = sv[:105]
+        self.assertEqual(res.ivs, [(100, 105)])
+
+    def test_setitem_slice_merge(self):
+        sv = HTSeq.StretchVector(typecode='d')
+        sv[100: 110] = 1
+        sv[120: 130] = 2
+        sv[140: 150] = 3
+        sv[160: 170] = 4
+
+        # Within a stretch, the bounds are left alone even when their buffers
+        # are full
+        starts_buf = sv._starts_buf
+        sv[122: 125] = 8
+        self.assertIs(sv._starts_buf, starts_buf)
+        self.assertEqual(sv[123], 8)
+        sv[120: 130] = 2
+
+        # Start and end outside of stretches, swallowing two of them
+        sv[115: 155] = 5
+        self.assertEqual(
+            [(iv.start, iv.end) for iv in sv.ivs],
+            [(100, 110), (115, 155), (160, 170)],
+        )
+        np.testing.assert_almost_equal(
+            sv.stretches[1],
+            np.ones(40, np.float32) * 5,
+        )
+
+        # Start in a stretch, end outside of stretches
+        sv[150: 158] = 7
+        self.assertEqual(
+            [(iv.start, iv.end) for iv in sv.ivs],
+            [(100, 110), (115, 158), (160, 170)],
+        )
+        np.testing.assert_almost_equal(
+            sv.stretches[1][-10:],
+            np.array([5] * 2 + [7] * 8, np.float32),
+        )
+        self.assertEqual(sv[165], 4)
+
+        # Start and end in different stretches
+        sv[105: 165] = 6
+        self.assertEqual(len(sv.ivs), 1)
+        self.assertEqual(sv.ivs[0], (100, 170))
+        np.testing.assert_almost_equal(
+            sv.stretches[0],
+            np.array([1] * 5 + [6] * 60 + [4] * 5, np.float32),
+        )
+
+    def test_setitem_slice_invalid(self):
+        sv = HTSeq.StretchVector(typecode='d')
+        sv[100: 110] = 1
+        sv[120: 130] = 2
+
+        # Values that do not fit leave the StretchVector unchanged
+        with self.assertRaises(ValueError):
+            sv[105: 125] = np.arange(3)
+        with self.assertRaises(ValueError):
+            sv[125: 135] = np.arange(3)
+        self.assertEqual(sv.ivs, [(100, 110), (120, 130)])
+        self.assertEqual([len(s) for s in sv.stretches], [10, 10])
+        np.testing.assert_almost_equal(
+            sv.todense(),
+            np.array([1] * 10 + [np.nan] * 10 + [2] * 10, np.float32),
+        )
+
     def test_getitem_number(self):
         sv = HTSeq.StretchVector(typecode='d')
 
@@ -105,6 +225,155 @@ class TestStretchVector(unittest.TestCase):
             np.arange(30).astype(np.float32),
         )
 
+    def test_extend(self):
+        sv = HTSeq.StretchVector(typecode='d')
+        sv[100: 110] = 1
+        sv[140: 150] = 2
+
+        sv.extend(
+            [(105, 120), (200, 210), (115, 145), (130, 135)],
+            [3, np.arange(10), 4, 5],
+        )
+        self.assertEqual(sv.ivs, [(100, 150), (200, 210)])
+        np.testing.assert_almost_equal(
+            sv.stretches[0],
+            np.array([1] * 5 + [3] * 10 + [4] * 15 + [5] * 5 + [4] * 10 + [2] * 5,
+                     np.float32),
+        )
+        np.testing.assert_almost_equal(
+            sv.stretches[1],
+            np.arange(10).astype(np.float32),
+        )
+
+    def test_add_at(self):
+        sv = HTSeq.StretchVector(typecode='d')
+        sv[100: 110] = 1
+
+        # Within a stretch
+        sv.add_at(102, np.ones(3))
+        np.testing.assert_almost_equal(
+            sv.stretches[0],
+            np.array([1] * 2 + [2] * 3 + [1] * 5, np.float32),
+        )
+
+        # Partially outside a stretch
+        sv.add_at(108, np.ones(4))
+        self.assertEqual(sv.ivs, [(100, 112)])
+        np.testing.assert_almost_equal(
+            sv.stretches[0][-4:],
+            np.array([2, 2, 1, 1], np.float32),
+        )
+
+        # Add another StretchVector
+        other = HTSeq.StretchVector(typecode='d')
+        other[90: 101] = 1
+        other[111: 115] = 2
+        sv += other
+        self.assertEqual(sv.ivs, [(90, 115)])
+        self.assertEqual(sv[90], 1)
+        self.assertEqual(sv[100], 2)
+        self.assertEqual(sv[111], 3)
+        self.assertEqual(sv[114], 2)
+
+        # Across a gap between stretches, which counts as zero
+        sv[120: 125] = 5
+        sv.add_at(113, np.ones(10))
+        self.assertEqual(sv.ivs, [(90, 125)])
+        np.testing.assert_almost_equal(
+            sv.stretches[0][-12:],
+            np.array([3, 3, 1, 1, 1, 1, 1, 6, 6, 6, 5, 5], np.float32),
+        )
+
+        # Nothing to add, no empty stretch either
+        sv.add_at(50, [])
+        self.assertEqual(sv.ivs, [(90, 125)])
+
+        # Values that cannot be added leave the StretchVector unchanged
+        sv = HTSeq.StretchVector(typecode='i')
+        sv[0: 5] = 1
+        with self.assertRaises(TypeError):
+            sv.add_at(3, np.ones(5) * .5)
+        self.assertEqual(sv.ivs, [(0, 5)])
+        self.assertEqual(len(sv.stretches[0]), 5)
+
+    def test_getitem_slice(self):
+        sv = HTSeq.StretchVector(typecode='d')
+        sv[100: 110] = np.arange(10)
+        sv[120: 130] = 2
+        sv[140: 150] = np.arange(10)
+
+        res = sv[105: 145]
+        self.assertEqual(res.ivs, [(105, 110), (120, 130), (140, 145)])
+        np.testing.assert_almost_equal(
+            res.stretches[0],
+            np.arange(5, 10).astype(np.float32),
+        )
+        np.testing.assert_almost_equal(
+            res.stretches[2],
+            np.arange(5).astype(np.float32),
+        )
+
+        # Within a single stretch
+        res = sv[142: 146]
+        self.assertEqual(res.ivs, [(142, 146)])
+        np.testing.assert_almost_equal(
+            res.stretches[0],
+            np.arange(2, 6).astype(np.float32),
+        )
+
+        # Between stretches
+        res = sv[110: 120]
+        self.assertEqual(res.ivs, [])
+
+    def test_getitem_number_many_stretches(self):
+        sv = HTSeq.StretchVector(typecode='d')
+
+        # Enough stretches to go beyond the plain bisect lookup
+        for i in range(50):
+            sv[i * 10: i * 10 + 5] = i
+        self.assertEqual(len(sv.ivs), 50)
+        self.assertEqual(sv[0], 0)
+        self.assertEqual(sv[234], 23)
+        self.assertEqual(sv[494], 49)
+        self.assertEqual(sv[235], None)
+        self.assertEqual(sv[495], None)
+        self.assertEqual(sv[-1], None)
+
+    def test_pickle(self):
+        sv = HTSeq.StretchVector(typecode='d')
+        sv[0: 5] = 1
+        sv[10: 15] = 2
+        sv[20: 25] = 3
+
+        for sv_new in (pickle.loads(pickle.dumps(sv)), copy.deepcopy(sv)):
+            self.assertEqual(sv_new.ivs, sv.ivs)
+            sv_new.shift(100)
+            sv_new[130: 135] = 9
+            self.assertEqual(
+                sv_new.ivs, [(100, 105), (110, 115), (120, 125), (130, 135)])
+            self.assertEqual(sv_new[130], 9)
+        self.assertEqual(sv.ivs, [(0, 5), (10, 15), (20, 25)])
+        self.assertNotIn('_ops', sv.__getstate__())
+
+        # A shallow copy has its own stretch list and bounds
+        sv_new = copy.copy(sv)
+        sv_new[5: 45] = 9
+        self.assertEqual(sv.ivs, [(0, 5), (10, 15), (20, 25)])
+        self.assertEqual(len(sv.stretches), 3)
+        self.assertEqual(sv_new.ivs, [(0, 5), (5, 45)])
+
+        # State pickled before the bounds were stored as arrays
+        sv_new = HTSeq.StretchVector.__new__(HTSeq.StretchVector)
+        sv_new.__setstate__({
+            'typecode': 'd',
+            'ivs': [(0, 5)],
+            'stretches': [np.ones(5, np.float32)],
+        })
+        self.assertEqual(sv_new.ivs, [(0, 5)])
+        sv_new[3: 8] = 2
+        self.assertEqual(sv_new.ivs, [(0, 8)])
+        self.assertEqual(sv_new[1], 1)
+
     def test_todense(self):
         sv = HTSeq.StretchVector(typecode='d')
         sv[450: 455] = 6.7
@@ -115,6 +384,98 @@ class TestStretchVector(unittest.TestCase):
             np.array([6.7] * 5 + [np.nan] * 5 + [1.7] * 5).astype(np.float32),
         )
 
+        # Same, writing NaN in the gaps only as for long stretches
+        sv = HTSeq.StretchVector(typecode='d')
+        sv._todense_fill_max = 0
+        sv[450: 455] = 6.7
+        sv[460: 465] = 1.7
+        np.testing.assert_almost_equal(sv.todense(), res)
+
+    def test_todense_cache(self):
+        sv = HTSeq.StretchVector(typecode='d')
+        sv[450: 455] = 6.7
+        sv[460: 465] = 1.7
+        res = sv.todense()
+        self.assertIs(sv.todense(), res)
+        self.assertFalse(res.flags.writeable)
+
+        # Modifications invalidate the cache
+        sv[455: 460] = 3
+        res = sv.todense()
+        np.testing.assert_almost_equal(
+            res,
+            np.array([6.7] * 5 + [3] * 5 + [1.7] * 5).astype(np.float32),
+        )
+        sv.shift(10)
+        self.assertIsNot(sv.todense(), res)
+
+        # So do modifications through views
+        sv.todense()
+        sub = sv[465: 470]
+        sub += 1
+        self.assertEqual(sv.todense()[0], np.float32(6.7))
+        self.assertEqual(sv.todense()[5], 4)
+
+        # Views are not cached, since their parent can change their data
+        sv[450: 455] = 1
+        sub = sv[450: 480]
+        res = sub.todense()
+        self.assertTrue(res.flags.writeable)
+        sv[451: 453] = 9
+        self.assertEqual(sub.todense()[1], 9)
+        other = sv[450: 480]
+        other[452: 453] = 7
+        self.assertEqual(sub.todense()[2], 7)
+
+        # Views do not keep their parent alive
+        del sv, other
+        sub[452: 453] = 5
+        self.assertEqual(sub.todense()[2], 5)
+
+        # The cache is not pickled
+        sv = HTSeq.StretchVector(typecode='d')
+        sv[0: 10] = 1
+        sv[500000: 500010] = 2
+        self.assertIs(sv.todense(), sv.todense())
+        self.assertLess(len(pickle.dumps(sv)), 10000)
+
+    def test_todense_parallel(self):
+        sv = HTSeq.StretchVector(typecode='d')
+        expected = np.empty(1000, np.float32)
+        expected[:] = np.nan
+        for i in range(0, 990, 30):
+            sv[i: i + 20] = np.arange(20)
+            expected[i: i + 20] = np.arange(20)
+        expected = expected[:i + 20]
+
+        # Force stitching in threads even for this short array
+        sv._parallel_todense_min = 0
+        sv._parallel_todense_threads = 4
+        np.testing.assert_almost_equal(sv.todense(), expected)
+
+        sv._todense_fill_max = 0
+        np.testing.assert_almost_equal(sv._todense(), expected)
+
+    def test_to_sparse(self):
+        sv = HTSeq.StretchVector(typecode='d')
+        sv[450: 455] = 6.7
+        sv[460: 465] = np.arange(5)
+        res = sv.to_sparse()
+        self.assertEqual(res.shape, (1, 465))
+        self.assertEqual(res.nnz, 10)
+        expected = np.zeros(465, np.float32)
+        expected[450: 455] = 6.7
+        expected[460: 465] = np.arange(5)
+        np.testing.assert_almost_equal(res.toarray()[0], expected)
+
+    def test_from_dense_dtype(self):
+        sv = HTSeq.StretchVector.from_dense(np.arange(5, dtype=np.int32))
+        self.assertEqual(sv.typecode, 'i')
+        self.assertEqual(sv.ivs, [(0, 5)])
+
+        with self.assertRaises(TypeError):
+            HTSeq.StretchVector.from_dense(np.arange(5, dtype=np.int8))
+
     def test_from_dense(self):
         array = np.empty(20, np.float32)
         array[:] = np.nan
@@ -217,8 +578,84 @@ class TestStretchVector(unittest.TestCase):
             78 * np.ones(1).astype(np.float32),
         )
 
+        # Single flip right after the first element
+        array = np.array([np.nan, 1, 2], np.float32)
+        sv = HTSeq.StretchVector.from_dense(array, offset=300)
+        self.assertEqual(sv.ivs, [(301, 303)])
+        np.testing.assert_almost_equal(sv.stretches[0], [1, 2])
+
+        array = np.array([1, np.nan, np.nan], np.float32)
+        sv = HTSeq.StretchVector.from_dense(array, offset=300)
+        self.assertEqual(sv.ivs, [(300, 301)])
+        np.testing.assert_almost_equal(sv.stretches[0], [1])
+
+    def test_copy_shift(self):
+        sv = HTSeq.StretchVector(typecode='d')
+        sv[100: 110] = 1
+        sv[120: 130] = 2
+
+        sv_copy = sv.copy()
+        sv_copy.shift(50)
+        self.assertEqual(sv_copy.ivs, [(150, 160), (170, 180)])
+        self.assertEqual(sv.ivs, [(100, 110), (120, 130)])
+        self.assertEqual(sv_copy[175], 2)
+        self.assertEqual(sv_copy[125], None)
+
+        sv_copy.stretches[0][:] = 3
+        self.assertEqual(sv[100], 1)
+
 
 if __name__ == '__main__':
 
     suite = TestStretchVector()
     suite.test_init()
+
+
+# The numba and pure Python kernels are only used when the Cython extension
+# is not built, so compare them to it
+@unittest.skipIf(
+    sv_module._StretchVector is None, 'Cython kernels not built')
+class TestStretchVectorKernels(unittest.TestCase):
+    def kernels(self, name):
+        kernel = getattr(sv_module, name)
+        # Compiled numba functions keep the pure Python one as py_func
+        return [kernel] + ([kernel.py_func] if hasattr(kernel, 'py_func') else [])
+
+    def test_bounds_kernels(self):
+        ext = sv_module._StretchVector
+        rng = np.random.default_rng(0)
+        for _ in range(300):
+            n = int(rng.integers(0, 8))
+            edges = np.sort(rng.choice(100, 2 * n, replace=False)).astype(np.int64)
+            starts, ends = edges[0::2].copy(), edges[1::2].copy()
+            start = int(rng.integers(-5, 105))
+            end = start + int(rng.integers(1, 30))
+
+            expected = ext.find_overlap(starts, ends, start, end)
+            for kernel in self.kernels('_find_overlap_nb'):
+                self.assertEqual(
+                    tuple(int(x) for x in kernel(starts, ends, start, end)),
+                    expected)
+
+            starts_buf = np.zeros(n + 1, np.int64)
+            ends_buf = np.zeros(n + 1, np.int64)
+            starts_buf[:n], ends_buf[:n] = starts, ends
+            n_new = ext.splice_bounds(
+                starts_buf, ends_buf, n, *expected)
+            for kernel in self.kernels('_splice_bounds_nb'):
+                starts_k = np.zeros(n + 1, np.int64)
+                ends_k = np.zeros(n + 1, np.int64)
+                starts_k[:n], ends_k[:n] = starts, ends
+                self.assertEqual(
+                    kernel(starts_k, ends_k, n, *expected), n_new)
+                np.testing.assert_array_equal(
+                    starts_k[:n_new], starts_buf[:n_new])
+                np.testing.assert_array_equal(ends_k[:n_new], ends_buf[:n_new])
+
+            index = int(rng.integers(-5, 105))
+            idx = ext.in_stretch(starts, ends, index)
+            expected_idx = -1
+            for i in range(n):
+                if starts[i] <= index < ends[i]:
+                    expected_idx = i
+            self.assertEqual(idx, expected_idx)